@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Compares scv_compute_atlas_region_stats against the original
+#   per-voxel loop on a synthetic atlas, TTP map, and value map.
+#
+#   python BenchmarkAtlasRegionStats.py [size] [number_of_regions]
+
+import os
+import sys
+import time
+
+import numpy as np
+
+import itk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..','lib'))
+from StroCoVess_Lib import scv_compute_atlas_region_stats
+
+
+def loop_compute_atlas_region_stats(atlas_im,
+                                    time_im,
+                                    vess_im,
+                                    number_of_time_bins=100):
+    atlas_arr = itk.GetArrayFromImage(atlas_im)
+    time_arr = itk.GetArrayFromImage(time_im)
+    vess_arr = itk.GetArrayFromImage(vess_im)
+
+    num_regions = int(atlas_arr.max())
+    time_max = float(time_arr.max())
+    time_min = float(time_arr.min())
+    nbins = int(number_of_time_bins)
+    time_factor = (time_max-time_min)/(nbins+1)
+
+    bin_value = np.zeros([num_regions,nbins])
+    bin_count = np.zeros([num_regions,nbins])
+
+    for atlas_region in range(num_regions):
+        indx_arr = np.where(atlas_arr==atlas_region)
+        indx_list = list(zip(indx_arr[0],indx_arr[1],indx_arr[2]))
+        for indx in indx_list:
+            time_bin = int((float(time_arr[indx])-time_min)/time_factor)
+            time_bin = min(max(0,time_bin),nbins-1)
+            if np.isnan(vess_arr[indx]) == False:
+                bin_count[atlas_region,time_bin] += 1
+                bin_value[atlas_region,time_bin] += vess_arr[indx]
+
+    bin_label = np.arange(nbins) * time_factor - time_min
+    bin_value = np.divide(bin_value,bin_count,out=bin_value,
+        where=bin_count!=0)
+
+    return bin_label,bin_value,bin_count
+
+
+if __name__ == '__main__':
+    size = 96
+    num_regions = 5
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_regions = int(sys.argv[2])
+
+    rng = np.random.default_rng(0)
+    shape = [size//2,size,size]
+    atlas_arr = rng.integers(0,num_regions+1,shape).astype(np.float32)
+    time_arr = rng.uniform(0,40,shape).astype(np.float32)
+    vess_arr = rng.normal(50,10,shape).astype(np.float32)
+    vess_arr[rng.random(shape)<0.05] = np.nan
+
+    atlas_im = itk.GetImageFromArray(atlas_arr)
+    time_im = itk.GetImageFromArray(time_arr)
+    vess_im = itk.GetImageFromArray(vess_arr)
+
+    quiet = lambda label,percent: None
+
+    start = time.perf_counter()
+    loop_results = loop_compute_atlas_region_stats(atlas_im,time_im,vess_im)
+    loop_time = time.perf_counter()-start
+
+    start = time.perf_counter()
+    results = scv_compute_atlas_region_stats(atlas_im,time_im,vess_im,
+        report_progress=quiet)
+    vectorized_time = time.perf_counter()-start
+
+    for name,loop_result,result in zip(["bin_label","bin_value","bin_count"],
+                                       loop_results,results):
+        print(name,"matches:",np.allclose(loop_result,result))
+    print("Voxels:",int(np.prod(shape)))
+    print("Loop:       {:.3f} s".format(loop_time))
+    print("Vectorized: {:.3f} s".format(vectorized_time))
+    print("Speedup:    {:.1f}x".format(loop_time/max(vectorized_time,1e-9)))
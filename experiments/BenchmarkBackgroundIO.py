@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Measures whether ITK image I/O can overlap with other work in the same
+#   process, and what reading CTP frames ahead in a separate process
+#   (CTP_FrameSource) saves, on synthetic frames.
+#
+#   python BenchmarkBackgroundIO.py [number_of_frames] [size]
+#
+# GIL: an ITK call runs in a thread while the main thread counts in a
+#   Python loop.  The loop's rate during the call, relative to its idle
+#   rate, is near 0% if the call holds the GIL.
+# Frames: a consumer blurs each frame (a stand-in for registration).
+#   "blocked" is the time the consumer waits for its next frame.
+# Hand-off: a frame is written as a compressed .mha inline, through
+#   CTP_ArtifactWriter (a scratch file that the writer's process maps),
+#   and by pickling it to the writer's process.  "blocked" is the time
+#   until the caller can continue, "CPU" is the caller's CPU time until
+#   the write is done, and "done" is the time until the write is done.
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import itk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..','lib'))
+from StroCoVess_Lib import CTP_FrameSource
+from StroCoVess_Lib import CTP_ArtifactWriter, scv_write_artifact
+
+
+def measure_gil(function):
+    done = threading.Event()
+    elapsed = {}
+    def run():
+        start = time.perf_counter()
+        function()
+        elapsed["call"] = time.perf_counter()-start
+        done.set()
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter()-start < 0.5:
+        count += 1
+    idle_rate = count/0.5
+
+    thread = threading.Thread(target=run)
+    count = 0
+    start = time.perf_counter()
+    thread.start()
+    while not done.is_set():
+        count += 1
+    busy_rate = count/(time.perf_counter()-start)
+    thread.join()
+    return elapsed["call"],100*busy_rate/idle_rate
+
+def iterate_frames(frames):
+    blocked = 0
+    start = time.perf_counter()
+    frame_iterator = iter(frames)
+    for i in range(len(frames)):
+        wait_start = time.perf_counter()
+        frame = next(frame_iterator)
+        blocked += time.perf_counter()-wait_start
+        itk.smoothing_recursive_gaussian_image_filter(frame,sigma=1.0)
+    return time.perf_counter()-start,blocked
+
+def measure_hand_off(function):
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    future = function()
+    blocked = time.perf_counter()-start
+    future.result()
+    return blocked,time.process_time()-start_cpu,time.perf_counter()-start
+
+
+if __name__ == '__main__':
+    num_frames = 6
+    size = 384
+    if len(sys.argv) > 1:
+        num_frames = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        size = int(sys.argv[2])
+
+    print("Cores:",os.cpu_count())
+    rng = np.random.default_rng(0)
+    shape = [size*5//12,size,size]
+    base_arr = rng.normal(40,20,shape).astype(np.float32)
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = []
+        for i in range(num_frames):
+            im = itk.GetImageFromArray(base_arr+
+                rng.normal(0,5,shape).astype(np.float32))
+            filenames.append(os.path.join(dirname,
+                "CTP{:02}.mha".format(i)))
+            itk.imwrite(im,filenames[-1],compression=True)
+        im = itk.imread(filenames[0],itk.F)
+        print("Frame: {} voxels, {:.0f} MB".format(int(np.prod(shape)),
+            im.GetLargestPossibleRegion().GetNumberOfPixels()*4/1e6))
+
+        print("GIL (main thread progress during the call):")
+        for label,function in [
+                ("imread compressed .mha",
+                    lambda: itk.imread(filenames[1],itk.F)),
+                ("imwrite compressed .mha",
+                    lambda: itk.imwrite(im,os.path.join(dirname,"out.mha"),
+                        compression=True)),
+                ("imwrite .nii",
+                    lambda: itk.imwrite(im,os.path.join(dirname,"out.nii"))),
+                ("imwrite .nii.gz",
+                    lambda: itk.imwrite(im,os.path.join(dirname,
+                        "out.nii.gz"),compression=True))]:
+            call_time,progress = measure_gil(function)
+            print("  {:26} {:6.2f} s, {:5.1f}%".format(label,call_time,
+                progress))
+
+        print("Frames (consumer blurs each frame):")
+        # Untimed pass, so that every timed pass starts from the same state
+        iterate_frames(CTP_FrameSource(filenames,look_ahead=0))
+        for look_ahead in [0,2]:
+            wall,blocked = iterate_frames(CTP_FrameSource(filenames,
+                look_ahead=look_ahead))
+            print("  look_ahead {}: {:6.2f} s, blocked {:6.2f} s".format(
+                look_ahead,wall,blocked))
+
+        print("Hand-off (compressed .mha):")
+        start = time.perf_counter()
+        itk.imwrite(im,os.path.join(dirname,"out.mha"),compression=True)
+        print("  {:26} {:6.2f} s".format("inline",time.perf_counter()-start))
+        writer = CTP_ArtifactWriter(fsync=False)
+        pool = ProcessPoolExecutor(max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"))
+        # Untimed writes, so that both processes have started
+        writer.write_image(im,os.path.join(dirname,"out.mha")).result()
+        pool.submit(int).result()
+        for label,function in [
+                ("CTP_ArtifactWriter",
+                    lambda: writer.write_image(im,os.path.join(dirname,
+                        "out.mha"))),
+                ("pickled",
+                    lambda: pool.submit(scv_write_artifact,"image",
+                        os.path.join(dirname,"out.mha"),im,
+                        {"compression": True},False))]:
+            for i in range(2):
+                blocked,cpu,done = measure_hand_off(function)
+                print("  {:26} blocked {:5.2f} s, CPU {:5.2f} s, "
+                    "done {:5.2f} s".format(label,blocked,cpu,done))
+        writer.close()
+        pool.shutdown()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Measures scv_compute_ctp_registration_score and
+#   scv_measure_ctp_image_motion on a synthetic head phantom (bone shell,
+#   textured brain, vessels, CT noise) moved by known rigid offsets, to
+#   set the warm start and motion tolerances of scv_register_ctp_images.
+#
+#   python BenchmarkRegistrationScore.py [size] [noise]
+#
+# Each moving frame is the phantom at a contrast level (0 = as the fixed
+#   frame, 1 = bolus peak: brain +25 HU, vessels +250 HU), translated
+#   along x and/or rotated about z, with new noise.
+
+import os
+import sys
+
+import numpy as np
+
+import itk
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..','lib'))
+from StroCoVess_Lib import scv_prepare_ctp_registration_fixed_image
+from StroCoVess_Lib import scv_compute_ctp_registration_score
+from StroCoVess_Lib import scv_measure_ctp_image_motion
+from StroCoVess_Lib import scv_shrink_image
+
+
+def make_phantom(size, noise, rng, shift=0.0, angle=0.0, contrast=0.0):
+    shape = [size//2,size,size]
+    z,y,x = np.meshgrid(*[np.arange(n,dtype=np.float64)-n/2 for n in shape],
+        indexing='ij')
+    # Sample the phantom at the inverse-moved points
+    c = np.cos(np.radians(angle))
+    s = np.sin(np.radians(angle))
+    x = x-shift
+    x,y = c*x+s*y,-s*x+c*y
+    r = np.sqrt((x/(0.45*size))**2+(y/(0.38*size))**2+(z/(0.4*size))**2)
+    arr = np.full(shape,-1000.0)
+    brain = r < 0.9
+    arr[brain] = 35+8*np.sin(x[brain]/3.1)*np.cos(y[brain]/4.3)+ \
+        5*np.sin(z[brain]/2.7+y[brain]/5.9)
+    arr[brain] += 25*contrast
+    vessels = brain & ((np.abs(np.sin(x/7.0+y/11.0)) < 0.08) |
+        (np.abs(np.sin(y/9.0-z/5.0)) < 0.08))
+    arr[vessels] += 60+250*contrast
+    bone = (r >= 0.9) & (r < 1.0)
+    arr[bone] = 450+150*np.sin(x[bone]/5.0+z[bone]/3.0)
+    arr += rng.normal(0,noise,shape)
+    return itk.GetImageFromArray(arr.astype(np.float32))
+
+def get_scores(fixed_im, mask_obj, fixed_small_im, moving_im):
+    identity_tfm = itk.AffineTransform[itk.D,3].New()
+    score = scv_compute_ctp_registration_score(fixed_im,mask_obj,
+        moving_im,identity_tfm)
+    motion = scv_measure_ctp_image_motion(fixed_small_im,mask_obj,
+        moving_im,4)
+    return score,motion
+
+
+if __name__ == '__main__':
+    size = 96
+    noise = 10.0
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        noise = float(sys.argv[2])
+
+    rng = np.random.default_rng(0)
+    quiet = lambda label,percent: None
+    fixed_im,mask_obj = scv_prepare_ctp_registration_fixed_image(
+        make_phantom(size,noise,rng),quiet)
+    fixed_small_im = scv_shrink_image(fixed_im,4)
+
+    print("Phantom: {} voxels, noise {} HU".format(size*size*(size//2),
+        noise))
+    print("{:>8} {:>8} {:>8} {:>10} {:>10}".format("contrast","shift",
+        "angle","score","motion"))
+    for contrast in [0.0,1.0]:
+        for shift,angle in [(0,0),(0.25,0),(0.5,0),(1,0),(2,0),(3,0),
+                            (0,0.5),(0,1),(0,2),(1,1)]:
+            moving_im = make_phantom(size,noise,rng,shift,angle,contrast)
+            score,motion = get_scores(fixed_im,mask_obj,fixed_small_im,
+                moving_im)
+            print("{:8.1f} {:8.2f} {:8.1f} {:10.5f} {:10.5f}".format(
+                contrast,shift,angle,score,motion))
@@ -1,6 +1,9 @@
 import os
 import sys
 import subprocess
+import multiprocessing
+import queue
+import traceback
 import pathlib
 from pathlib import Path
 import csv
@@ -37,6 +40,255 @@ def get_atlas_path():
 
 sys.path.append(get_lib_path())
 from StroCoVess_Lib import *
+from ToggleFrame import ToggledFrame
+
+#################################
+#################################
+#################################
+class JobCancelled(Exception):
+    pass
+
+def run_job(function, args, options, debug, progress_queue, cancel_event):
+    # Runs one pipeline job in a worker process.  Progress is sent to the
+    #   app through progress_queue.  A cancel request is honored at the
+    #   next progress or subprogress report.
+    def report_progress(label, percentage):
+        if cancel_event.is_set():
+            raise JobCancelled()
+        progress_queue.put(("progress",label,percentage))
+
+    def report_subprogress(label, percentage):
+        if cancel_event.is_set():
+            raise JobCancelled()
+        progress_queue.put(("subprogress",label,percentage))
+
+    try:
+        function(*args,
+            **options,
+            report_progress=report_progress,
+            report_subprogress=report_subprogress,
+            debug=debug)
+        progress_queue.put(("done","Done",100))
+    except JobCancelled:
+        progress_queue.put(("cancelled","Cancelled",0))
+    except Exception as error:
+        traceback.print_exc()
+        progress_queue.put(("failed",str(error),100))
+
+def process_study(ctp_files,
+                  cta_file,
+                  dsa_file,
+                  cbf_file,
+                  cbv_file,
+                  tmax_file,
+                  ttp_file,
+                  out_dir,
+                  atlas_path,
+                  report_progress=print,
+                  report_subprogress=print,
+                  debug=False,
+                  slab_size=None,
+                  atlas_shrink_factors=None,
+                  perfusion_sampler="tubemath"):
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    # Outputs are written in the background while the study is processed
+    artifact_writer = CTP_ArtifactWriter()
+    try:
+        # User must supply either CTA or CTP data
+        # They can also provide DSA data, but it must have had
+        #    the brain extracted already.
+        cta_im = None
+        dsa_im = None
+        if len(ctp_files)>0:
+            report_progress("Converting CTP to CTA",5)
+            ct_im,cta_im,dsa_im = scv_convert_ctp_to_cta(ctp_files,
+                report_progress = report_subprogress,
+                debug=debug,
+                output_dirname=out_dir,
+                slab_size=slab_size)
+            report_progress("Converting CTP to CTA",10)
+            artifact_writer.write_image(ct_im,os.path.join(out_dir,"ct.mha"))
+            artifact_writer.write_image(cta_im,os.path.join(out_dir,"cta.mha"))
+            artifact_writer.write_image(dsa_im,os.path.join(out_dir,"dsa.mha"))
+        elif len(cta_file)>0:
+            report_progress("Reading CTA",5)
+            cta_im = itk.imread(cta_file, itk.F)
+            report_progress("Reading CTA",10)
+        elif len(dsa_file)>0:
+            report_progress("Reading DSA",5)
+            dsa_im = itk.imread(dsa_file,itk.F)
+            report_progress("Reading DSA",10)
+        else:
+            raise ValueError("Must set CTP files or CTA file.")
+
+        if dsa_im==None and len(dsa_file)>0:
+            report_progress("Reading DSA",5)
+            dsa_im = itk.imread(dsa_file,itk.F)
+            report_progress("Reading DSA",10)
+
+        report_progress("Segmenting Brain",20)
+        if cta_im != None:
+            cta_brain_im,mask_brain = scv_segment_brain_from_ct(cta_im,
+                report_progress = report_subprogress,
+                debug=debug)
+            artifact_writer.write_image(cta_brain_im,
+                os.path.join(out_dir,"cta_brain.mha"))
+            # Use CTA brain to mask DSA and create DSA_Brain image
+            if dsa_im != None:
+                ImageMath = tube.ImageMath.New(Input=dsa_im)
+                ImageMath.ReplaceValuesOutsideMaskRange(cta_brain_im,
+                    0.000001,9999,0)
+                dsa_brain_im = ImageMath.GetOutput()
+                artifact_writer.write_image(dsa_brain_im,
+                    os.path.join(out_dir,"dsa_brain.mha"))
+        else:
+            # If it is required and a CTA wasn't provided
+            #   or CTA wasn't generated from CTP, then throw and error
+            raise ValueError("Cannot perform brain segmentation using DSA.\n" +
+                "Please also include CTP or CTA data.")
+
+        in_im = cta_im
+        in_brain_im = cta_brain_im
+        in_name = "cta"
+        # If DSA is available, use it instead of CTA
+        if dsa_im != None:
+            in_im = dsa_im
+            in_brain_im = dsa_brain_im
+            in_name = "dsa"
+
+        report_progress("Enhancing vessels",40)
+        # Enhancing vessels creates an image in which intensity is
+        #    related to "vesselness" instead of being related to the
+        #    amount of contrast agent in the vessel.  This simplifies
+        #    subsequent vessel seeding and traversal stopping criteria.
+        in_vess_im,in_brain_vess_im = scv_enhance_vessels_in_cta(
+            in_im,
+            in_brain_im,
+            report_progress=report_subprogress,
+            debug=debug)
+        artifact_writer.write_image(in_vess_im,
+            os.path.join(out_dir,
+                in_name+"_vessels_enhanced.mha"))
+        artifact_writer.write_image(in_brain_vess_im,
+            os.path.join(out_dir,
+                in_name+"_brain_vessels_enhanced.mha"))
+
+        report_progress("Extracting vessels",60)
+        vess_mask_im,vess_so = scv_extract_vessels_from_cta(
+            in_vess_im,
+            in_brain_vess_im,
+            report_progress=report_subprogress,
+            debug=debug,
+            output_dirname=out_dir)
+
+        artifact_writer.write_image(in_brain_vess_im,
+            os.path.join(out_dir,
+                in_name+"_vessels_extracted.mha"))
+        artifact_writer.write_tubes(vess_so,
+            os.path.join(out_dir,in_name+"_vessels_extracted.tre"),
+            os.path.join(out_dir,in_name+"_vessels_extracted.vtp"))
+
+        report_progress("Generating Perfusion Stats",80)
+
+        atlas_im = itk.imread(
+            os.path.join(atlas_path,'atlas_brainweb.mha'),
+            itk.F)
+        atlas_mask_im = itk.imread(
+            os.path.join(atlas_path,'atlas_brainweb_mask.mha'),
+            itk.F)
+        atlas_reg_im,atlas_mask_reg_im = scv_register_atlas_to_image(
+            atlas_im,
+            atlas_mask_im,
+            in_brain_im,
+            shrink_factors=atlas_shrink_factors)
+        ImageMath = tube.ImageMath.New(Input=atlas_mask_reg_im)
+        ImageMath.ReplaceValuesOutsideMaskRange(vess_mask_im,
+            0.000001,9999,4)
+        ImageMath.ReplaceValuesOutsideMaskRange(cta_brain_im,
+            0.000001,9999,0)
+        vess_atlas_mask_im = ImageMath.GetOutput()
+        artifact_writer.write_image(vess_atlas_mask_im,
+            os.path.join(out_dir,
+                in_name+"_vess_atlas_mask.mha"))
+
+        graph_label = None
+        graph_data = None
+        map_filenames = {name: filename for name,filename in
+            [("TTP",ttp_file),("CBF",cbf_file),("CBV",cbv_file),
+             ("TMax",tmax_file)] if len(filename) > 0}
+        # perfusion_sampler is as in scv_generate_vessel_report
+        if perfusion_sampler == "numpy":
+            stats_ims = {name: itk.imread(filename,itk.F)
+                for name,filename in map_filenames.items()}
+            report_progress("Sampling perfusion maps",95)
+            scv_sample_perfusion_maps_at_tubes(vess_so,stats_ims,
+                vess_atlas_mask_im)
+        else:
+            TubeMath = tube.TubeMath[3,itk.F].New()
+            TubeMath.SetInputTubeGroup(vess_so)
+            TubeMath.SetUseAllTubes()
+            TubeMath.ComputeTubeRegions(vess_atlas_mask_im)
+            report_progress("Resampling perfusion maps",92)
+            stats_ims = scv_resample_perfusion_maps(map_filenames,
+                vess_atlas_mask_im)
+            report_progress("Sampling perfusion maps",95)
+            scv_sample_perfusion_maps(TubeMath,stats_ims,point_smoothing=0,
+                tissue_smoothing=0)
+
+        if "TTP" in stats_ims:
+            # All maps share a single region/time-bin assignment
+            if perfusion_sampler == "numpy":
+                time_bin,stats_bin,stats_count = \
+                    scv_compute_atlas_region_stats_from_maps(
+                        vess_atlas_mask_im,
+                        "TTP",
+                        stats_ims,
+                        100,
+                        report_subprogress)
+            else:
+                time_bin,stats_bin,stats_count = \
+                    scv_compute_atlas_region_stats_multi(
+                        vess_atlas_mask_im,
+                        stats_ims["TTP"],
+                        stats_ims,
+                        100,
+                        report_subprogress)
+            graph_label,graph_data = scv_atlas_region_stats_to_graph(
+                time_bin,stats_bin,stats_count["TTP"])
+
+        report_progress("Saving results",99)
+        property_names = []
+        for name in stats_ims:
+            property_names += [name,name+"_Tissue"]
+        artifact_writer.write_tubes(vess_so,
+            os.path.join(out_dir,in_name+"_vessels_extracted_perf.tre"),
+            os.path.join(out_dir,in_name+"_vessels_extracted_perf.vtp"),
+            os.path.join(out_dir,in_name+"_vessels_extracted_perf.npz"),
+            property_names)
+
+        # The region stats are binned by TTP, so there are none without
+        #   a TTP map
+        if graph_data is not None:
+            csvfilename = os.path.join(out_dir,
+                in_name+"_vessels_extracted_perf.csv")
+            csvfile = open(csvfilename,'w',newline='')
+            csvwriter = csv.writer(csvfile,
+                dialect='excel',
+                quoting=csv.QUOTE_NONE)
+            csvwriter.writerow(graph_label)
+            for r in range(graph_data.shape[1]):
+                csvwriter.writerow(['{:f}'.format(x)
+                    for x in graph_data[:,r]])
+            csvfile.close()
+
+        # Every output is on disk before the study is done
+        artifact_writer.flush()
+        report_progress("Done!",100)
+    finally:
+        artifact_writer.close()
+
 from ToggleFrame import *
 
 class CTP_App(tk.Tk):
@@ -88,6 +340,16 @@ class CTP_App(tk.Tk):
 
         self.progress_status = ""
 
+        # Pipeline jobs run one at a time in a worker process so that the
+        #   UI stays responsive; further studies wait in self.jobs
+        self.jobs = []
+        self.job = None
+        self.job_process = None
+        # Workers are spawned rather than forked from the Tk process
+        self.job_context = multiprocessing.get_context("spawn")
+        self.job_progress_queue = self.job_context.Queue()
+        self.job_cancel_event = self.job_context.Event()
+
         self.title("SCV App")
 
         frm_title = tk.Frame(master=self)
@@ -100,6 +362,16 @@ class CTP_App(tk.Tk):
             text="Debug",
             variable=self.debug,
             pady=5).pack()
+        self.fast_registration = tk.IntVar()
+        ckb_fast_registration = tk.Checkbutton(master=frm_title,
+            text="Fast registration",
+            variable=self.fast_registration,
+            pady=5).pack()
+        self.low_memory = tk.IntVar()
+        ckb_low_memory = tk.Checkbutton(master=frm_title,
+            text="Low memory",
+            variable=self.low_memory,
+            pady=5).pack()
         frm_title.pack(fill=tk.BOTH)
     
         frm_utility = tk.Frame(master=self,
@@ -279,7 +551,19 @@ class CTP_App(tk.Tk):
             length=150,
             mode='determinate')
         self.pgb_subprogress.pack()
+
+        self.lst_jobs = tk.Listbox(frm_progress,
+            height=5,
+            width=50)
+        self.lst_jobs.pack(pady=5)
+        btn_cancel = tk.Button(master=frm_progress,
+            text="Cancel",
+            command=self.hdl_cancel,
+            width=20
+            ).pack(pady=5)
         frm_progress.pack(fill=tk.BOTH)
+
+        self.after(100,self.poll_jobs)
     
 
 #################################
@@ -391,15 +675,13 @@ class CTP_App(tk.Tk):
             initialdir=self.workflow_4d_out_dir))
 
     def hdl_workflow_4d_process(self):
-        self.report_progress("Generating 4D CTP report",5)
-        debug = False
-        if self.debug.get() == 1:
-            debug = True
-
         self.atlas_path = get_atlas_path()
-        scv_generate_4d_ctp_vessel_report( self.workflow_4d_in_file,
-            self.atlas_path,self.workflow_4d_out_dir,self.report_progress,
-            self.report_subprogress,debug)
+        self.submit_job("4D report: "+
+            os.path.basename(self.workflow_4d_in_file),
+            scv_generate_4d_ctp_vessel_report,
+            (self.workflow_4d_in_file,self.atlas_path,
+             self.workflow_4d_out_dir),
+            self.get_job_options())
 
 #################################
 #################################
@@ -447,15 +729,13 @@ class CTP_App(tk.Tk):
             initialdir=self.workflow_3d_out_dir))
 
     def hdl_workflow_3d_process(self):
-        self.report_progress("Generating 3D CTP report",5)
-        debug = False
-        if self.debug.get() == 1:
-            debug = True
-
         self.atlas_path = get_atlas_path()
-        scv_generate_3d_ctp_vessel_report( self.workflow_3d_in_files,
-            self.atlas_path,self.workflow_3d_out_dir, self.report_progress,
-            self.report_subprogress, debug)
+        self.submit_job("3D report: "+
+            os.path.basename(self.workflow_3d_out_dir),
+            scv_generate_3d_ctp_vessel_report,
+            (list(self.workflow_3d_in_files),self.atlas_path,
+             self.workflow_3d_out_dir),
+            self.get_job_options())
 
 
 #################################
@@ -498,14 +778,11 @@ class CTP_App(tk.Tk):
             initialdir=self.prep_3d_out_dir))
 
     def hdl_prep_3d_process(self):
-        self.report_progress("Registering images",5)
-        debug = False
-        if self.debug.get() == 1:
-            debug = True
-
-        scv_prepare_3d_for_perfusion_toolbox(self.prep_3d_in_files,
-            self.prep_3d_out_dir, self.report_progress,
-            self.report_subprogress, debug)
+        self.submit_job("Prepare 3D: "+
+            os.path.basename(self.prep_3d_out_dir),
+            scv_prepare_3d_for_perfusion_toolbox,
+            (list(self.prep_3d_in_files),self.prep_3d_out_dir),
+            self.get_job_options(atlas=False))
 
 #################################
 #################################
@@ -549,14 +826,11 @@ class CTP_App(tk.Tk):
             initialdir=self.prep_4d_out_dir))
 
     def hdl_prep_4d_process(self):
-        self.report_progress("Preparing 4D CTP image",5)
-        debug = False
-        if self.debug.get() == 1:
-            debug = True
-
-        scv_prepare_4d_for_perfusion_toolbox(self.prep_4d_in_file,
-            self.prep_4d_out_dir, self.report_progress,
-            self.report_subprogress, debug)
+        self.submit_job("Prepare 4D: "+
+            os.path.basename(self.prep_4d_in_file),
+            scv_prepare_4d_for_perfusion_toolbox,
+            (self.prep_4d_in_file,self.prep_4d_out_dir),
+            self.get_job_options(atlas=False))
 
 #################################
 #################################
@@ -647,315 +921,131 @@ class CTP_App(tk.Tk):
 #################################
     def report_progress(self, label, percentage):
         self.progress_status = label
-        print(label)
         self.lbl_progress['text'] = label
         self.pgb_progress['value'] = percentage
         self.pgb_subprogress['value'] = 0
-        self.update()
 
     def report_subprogress(self, label, percentage):
         progress_label = self.progress_status+": "+label
         self.lbl_progress['text'] = progress_label
-        print(progress_label)
         self.pgb_subprogress['value'] = percentage
-        self.update()
 
 #################################
 #################################
 #################################
     def hdl_process(self):
-        if not os.path.exists(self.process_out_dir):
-            os.mkdir(self.process_out_dir)
-
+        self.atlas_path = get_atlas_path()
+        self.submit_job("Process: "+os.path.basename(self.process_out_dir),
+            process_study,
+            (list(self.ctp_files),self.cta_file,self.dsa_file,
+             self.cbf_file,self.cbv_file,self.tmax_file,self.ttp_file,
+             self.process_out_dir,self.atlas_path),
+            self.get_job_options(registration=False))
+
+    def get_job_options(self, registration=True, atlas=True):
+        # Keyword arguments set by the "Fast registration" and "Low
+        #   memory" options.  registration and atlas select whether the
+        #   job registers CTP frames and the atlas, respectively.
+        options = {}
+        if self.fast_registration.get() == 1:
+            if registration:
+                options["warm_start"] = True
+                options["pyramid_shrink_factors"] = [4,2]
+            if atlas:
+                options["atlas_shrink_factors"] = [4,2]
+        if self.low_memory.get() == 1:
+            options["slab_size"] = 16
+        return options
+
+    def submit_job(self, label, function, args, options={}):
         debug = False
         if self.debug.get() == 1:
             debug = True
-
-        # User must supply either CTA or CTP data
-        # They can also provide DSA data, but it must have had
-        #    the brain extracted already.
-        cta_im = None
-        dsa_im = None
-        if len(self.ctp_files)>0:
-            self.report_progress("Converting CTP to CTA",5)
-            ct_im,cta_im,dsa_im = scv_convert_ctp_to_cta(self.ctp_files,
-                report_progress = self.report_subprogress,
-                debug=debug,
-                output_dir=self.process_out_dir)
-            self.report_progress("Converting CTP to CTA",10)
-            itk.imwrite(ct_im,os.path.join(self.process_out_dir,"ct.mha"),
-                compression=True)
-            itk.imwrite(cta_im,os.path.join(self.process_out_dir,"cta.mha"),
-                compression=True)
-            itk.imwrite(dsa_im,os.path.join(self.process_out_dir,"dsa.mha"),
-                compression=True)
-        elif len(self.cta_file)>0:
-            self.report_progress("Reading CTA",5)
-            cta_im = itk.imread(self.cta_file, itk.F)
-            self.report_progress("Reading CTA",10)
-        elif len(self.dsa_file)>0:
-            self.report_progress("Reading DSA",5)
-            dsa_im = itk.imread(self.dsa_file,itk.F)
-            self.report_progress("Reading DSA",10)
-        else:
-            self.report_progress("ERROR",100)
-            tk.messagebox.showerror(title="Error",
-                message="Must set CTP files or CTA file.")
+        self.jobs.append({"label": label,
+            "function": function,
+            "args": args,
+            "options": options,
+            "debug": debug,
+            "status": "queued"})
+        self.update_job_list()
+        if self.job == None:
+            self.start_next_job()
+
+    def start_next_job(self):
+        self.job = None
+        for job in self.jobs:
+            if job["status"] == "queued":
+                self.job = job
+                break
+        if self.job == None:
             return
-
-        if dsa_im==None and len(self.dsa_file)>0:
-            self.report_progress("Reading DSA",5)
-            dsa_im = itk.imread(self.dsa_file,itk.F)
-            self.report_progress("Reading DSA",10)
-
-        self.report_progress("Segmenting Brain",20)
-        if cta_im != None:
-            cta_brain_im,mask_brain = scv_segment_brain_from_ct(cta_im,
-                report_progress = self.report_subprogress,
-                debug=debug)
-            itk.imwrite(cta_brain_im,
-                os.path.join(self.process_out_dir,"cta_brain.mha"),
-                compression=True)
-            # Use CTA brain to mask DSA and create DSA_Brain image
-            if dsa_im != None:
-                ImageMath = tube.ImageMath.New(Input=dsa_im)
-                ImageMath.ReplaceValuesOutsideMaskRange(cta_brain_im,
-                    0.000001,9999,0)
-                dsa_brain_im = ImageMath.GetOutput()
-                itk.imwrite(dsa_brain_im,
-                    os.path.join(self.process_out_dir,"dsa_brain.mha"),
-                    compression=True)
-        else:
-            # If it is required and a CTA wasn't provided
-            #   or CTA wasn't generated from CTP, then throw and error
-            self.report_progress("ERROR",100)
+        self.job["status"] = "running"
+        self.job_cancel_event.clear()
+        self.report_progress(self.job["label"],0)
+        self.job_process = self.job_context.Process(target=run_job,
+            args=(self.job["function"],self.job["args"],
+                self.job["options"],self.job["debug"],
+                self.job_progress_queue,self.job_cancel_event))
+        self.job_process.start()
+        self.update_job_list()
+
+    def finish_job(self, status, message):
+        self.job["status"] = status
+        self.job_process.join()
+        self.job_process = None
+        self.update_job_list()
+        if status == "failed":
             tk.messagebox.showerror(title="Error",
-                message="Cannot perform brain segmentation using DSA.\n" +
-                        "Please also include CTP or CTA data.")
-            return
-
-        in_im = cta_im
-        in_brain_im = cta_brain_im
-        in_name = "cta"
-        # If DSA is available, use it instead of CTA
-        if dsa_im != None:
-            in_im = dsa_im
-            in_brain_im = dsa_brain_im
-            in_name = "dsa"
-
-        self.report_progress("Enhancing vessels",40)
-        # Enhancing vessels creates an image in which intensity is
-        #    related to "vesselness" instead of being related to the
-        #    amount of contrast agent in the vessel.  This simplifies
-        #    subsequent vessel seeding and traversal stopping criteria.
-        in_vess_im,in_brain_vess_im = scv_enhance_vessels_in_cta(
-            in_im,
-            in_brain_im,
-            report_progress=self.report_subprogress,
-            debug=debug)
-        itk.imwrite(in_vess_im,
-            os.path.join(self.process_out_dir,
-                in_name+"_vessels_enhanced.mha"),
-            compression=True)
-        itk.imwrite(in_brain_vess_im,
-            os.path.join(self.process_out_dir,
-                in_name+"_brain_vessels_enhanced.mha"),
-            compression=True)
-
-        self.report_progress("Extracting vessels",60)
-        vess_mask_im,vess_so = scv_extract_vessels_from_cta(
-            in_vess_im,
-            in_brain_vess_im,
-            report_progress=self.report_subprogress,
-            debug=debug,
-            output_dir=self.process_out_dir)
-
-        itk.imwrite(in_brain_vess_im,
-            os.path.join(self.process_out_dir,
-                in_name+"_vessels_extracted.mha"),
-            compression=True)
-
-        SOWriter = itk.SpatialObjectWriter[3].New()
-        SOWriter.SetInput(vess_so)
-        SOWriter.SetBinaryPoints(True)
-        SOWriter.SetFileName(os.path.join(self.process_out_dir,
-            in_name+"_vessels_extracted.tre"))
-        SOWriter.Update()
-
-        VTPWriter = itk.WriteTubesAsPolyData.New()
-        VTPWriter.SetInput(vess_so)
-        VTPWriter.SetFileName(os.path.join(self.process_out_dir,
-            in_name+"_vessels_extracted.vtp"))
-        VTPWriter.Update()
-        
-        self.report_progress("Generating Perfusion Stats",80)
-
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.atlas_path = get_atlas_path()
-        atlas_im = itk.imread(
-            os.path.join(self.atlas_path,'atlas_brainweb.mha'),
-            itk.F)
-        atlas_mask_im = itk.imread(
-            os.path.join(self.atlas_path,'atlas_brainweb_mask.mha'),
-            itk.F)
-        atlas_reg_im,atlas_mask_reg_im = scv_register_atlas_to_image(
-            atlas_im,
-            atlas_mask_im,
-            in_brain_im)
-        ImageMath = tube.ImageMath.New(Input=atlas_mask_reg_im)
-        ImageMath.ReplaceValuesOutsideMaskRange(vess_mask_im,
-            0.000001,9999,4)
-        ImageMath.ReplaceValuesOutsideMaskRange(cta_brain_im,
-            0.000001,9999,0)
-        vess_atlas_mask_im = ImageMath.GetOutput()
-        itk.imwrite(vess_atlas_mask_im,
-            os.path.join(self.process_out_dir,
-                in_name+"_vess_atlas_mask.mha"),
-            compression=True)
-
-        TubeMath = tube.TubeMath[3,itk.F].New()
-        TubeMath.SetInputTubeGroup(vess_so)
-        TubeMath.SetUseAllTubes()
-        TubeMath.ComputeTubeRegions(vess_atlas_mask_im)
+                message=self.job["label"]+" failed:\n"+message)
+        self.start_next_job()
+
+    def poll_jobs(self):
+        # Progress messages from the worker process are applied to the
+        #   UI here, on the Tk thread
+        while True:
+            try:
+                kind,label,percentage = self.job_progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.report_progress(label,percentage)
+            elif kind == "subprogress":
+                self.report_subprogress(label,percentage)
+            else:
+                self.report_progress(label,percentage)
+                self.finish_job(kind,label)
+        if self.job_process != None and not self.job_process.is_alive() \
+           and self.job_progress_queue.empty():
+            # The worker exited without reporting, e.g., it crashed
+            self.report_progress("ERROR",100)
+            self.finish_job("failed","Worker process exited with code "+
+                str(self.job_process.exitcode))
+        self.after(100,self.poll_jobs)
+
+    def hdl_cancel(self):
+        # The running job stops at its next progress report; queued jobs
+        #   are dropped
+        for job in self.jobs:
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+        if self.job != None:
+            self.job_cancel_event.set()
+            self.lbl_progress['text'] = "Cancelling..."
+        self.update_job_list()
+
+    def update_job_list(self):
+        self.lst_jobs.delete(0,tk.END)
+        for job in self.jobs:
+            self.lst_jobs.insert(tk.END,job["label"]+" ["+job["status"]+"]")
 
-        graph_label = None
-        graph_data = None
-        ttp_im = None
-        if len(self.ttp_file) > 0:
-            self.report_progress("Generating TTP Graphs",92)
-            ttp_im = itk.imread(self.ttp_file, itk.F)
-            Resample = tube.ResampleImage.New(Input=ttp_im)
-            Resample.SetMatchImage(vess_atlas_mask_im)
-            Resample.Update()
-            ttp_im = Resample.GetOutput()
-            TubeMath.SetPointValuesFromImage(ttp_im, "TTP")
-            TubeMath.SetPointValuesFromTubeRegions(ttp_im,
-                "TTP_Tissue",
-                1.5,
-                4)
-            time_bin,ttp_bin,ttp_count = scv_compute_atlas_region_stats(
-                vess_atlas_mask_im,
-                ttp_im,
-                ttp_im,
-                100,
-                self.report_subprogress)
-            graph_label = ["Bin_Num"]
-            graph_data = np.arange(len(time_bin))
-            graph_label = np.append(graph_label,"TPP")
-            graph_data = np.stack((graph_data,time_bin))
-            for r in range(1,ttp_bin.shape[0]):
-                graph_label = np.append(graph_label,
-                    "Count_Region_"+str(r))
-                graph_data = np.concatenate((graph_data,
-                    [ttp_count[r,:]]))
-            print(graph_label.shape)
-            print(graph_data.shape)
-
-
-        if len(self.cbf_file) > 0:
-            self.report_progress("Generating CBF Graphs",94)
-            cbf_im = itk.imread(self.cbf_file, itk.F)
-            Resample = tube.ResampleImage.New(Input=cbf_im)
-            Resample.SetMatchImage(vess_atlas_mask_im)
-            Resample.Update()
-            cbf_im = Resample.GetOutput()
-            TubeMath.SetPointValuesFromImage(cbf_im, "CBF")
-            TubeMath.SetPointValuesFromTubeRegions(cbf_im,
-                "CBF_Tissue",
-                1.5,
-                4)
-            if ttp_im!=None:
-                time_bin,cbf_bin,cbf_count = scv_compute_atlas_region_stats(
-                    vess_atlas_mask_im,
-                    ttp_im,
-                    cbf_im,
-                    100,
-                    self.report_subprogress)
-                for r in range(1,cbf_bin.shape[0]):
-                    graph_label = np.append(graph_label,
-                        "CBF_Region"+str(r))
-                    graph_data = np.concatenate((graph_data,
-                        [cbf_bin[r,:]]))
-
-        if len(self.cbv_file) > 0:
-            self.report_progress("Generating CBV Graphs",96)
-            cbv_im = itk.imread(self.cbv_file, itk.F)
-            Resample = tube.ResampleImage.New(Input=cbv_im)
-            Resample.SetMatchImage(vess_atlas_mask_im)
-            Resample.Update()
-            cbv_im = Resample.GetOutput()
-            TubeMath.SetPointValuesFromImage(cbv_im, "CBV")
-            TubeMath.SetPointValuesFromTubeRegions(cbv_im,
-                "CBV_Tissue",
-                1.5,
-                4)
-            if ttp_im!=None:
-                time_bin,cbv_bin,cbv_count = scv_compute_atlas_region_stats(
-                    vess_atlas_mask_im,
-                    ttp_im,
-                    cbv_im,
-                    100,
-                    self.report_subprogress)
-                for r in range(1,cbv_bin.shape[0]):
-                    graph_label = np.append(graph_label,
-                        "CBV_Region"+str(r))
-                    graph_data = np.concatenate((graph_data,
-                        [cbv_bin[r,:]]))
-        if len(self.tmax_file) > 0:
-            self.report_progress("Generating TMax Graphs",98)
-            tmax_im = itk.imread(self.tmax_file, itk.F)
-            Resample = tube.ResampleImage.New(Input=tmax_im)
-            Resample.SetMatchImage(vess_atlas_mask_im)
-            Resample.Update()
-            tmax_im = Resample.GetOutput()
-            TubeMath.SetPointValuesFromImage(tmax_im, "TMax")
-            TubeMath.SetPointValuesFromTubeRegions(tmax_im,
-                "TMax_Tissue",
-                1.5,
-                4)
-            if ttp_im!=None:
-                time_bin,tmax_bin,tmax_count = scv_compute_atlas_region_stats(
-                    vess_atlas_mask_im,
-                    ttp_im,
-                    tmax_im,
-                    100,
-                    self.report_subprogress)
-                for r in range(1,tmax_bin.shape[0]):
-                    graph_label = np.append(graph_label,
-                        "TMax_Region"+str(r))
-                    graph_data = np.concatenate((graph_data,
-                        [tmax_bin[r,:]]))
-
-        self.report_progress("Saving results",99)
-        SOWriter = itk.SpatialObjectWriter[3].New()
-        SOWriter.SetInput(vess_so)
-        SOWriter.SetBinaryPoints(True)
-        SOWriter.SetFileName(os.path.join(self.process_out_dir,
-            in_name+"_vessels_extracted_perf.tre"))
-        SOWriter.Update()
-
-        VTPWriter = itk.WriteTubesAsPolyData.New()
-        VTPWriter.SetInput(vess_so)
-        VTPWriter.SetFileName(os.path.join(self.process_out_dir,
-            in_name+"_vessels_extracted_perf.vtp"))
-        VTPWriter.Update()
-
-        csvfilename = os.path.join(self.process_out_dir,
-            in_name+"_vessels_extracted_perf.csv")
-        csvfile = open(csvfilename,'w',newline='')
-        csvwriter = csv.writer(csvfile,
-            dialect='excel',
-            quoting=csv.QUOTE_NONE)
-        csvwriter.writerow(graph_label)
-        for r in range(graph_data.shape[1]):
-            csvwriter.writerow(['{:f}'.format(x) for x in graph_data[:,r]])
-        csvfile.close()
-
-        self.report_progress("Done!",100)
-    
+#################################
+#################################
+#################################
 #################################
 #################################
 #################################
 if __name__ == '__main__':
+    # Required for the registration worker pool in bundled executables
+    multiprocessing.freeze_support()
     app = CTP_App()
     app.mainloop()
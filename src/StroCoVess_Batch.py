@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Headless batch processing of CTP studies.
+#
+#   python StroCoVess_Batch.py STUDIES -o OUTPUT_DIR [-j WORKERS]
+#
+# STUDIES is a directory or a manifest file.  In a directory, every 4D
+#   image file is a 4D study and every subdirectory of 3D images is a 3D
+#   study.  A manifest is either a text file with one study path per
+#   line, or a JSON list of {"name": ..., "ctp_4d": filename} and
+#   {"name": ..., "ctp_3d": [filenames]} entries.
+#
+# Each study is processed into OUTPUT_DIR/<name>.  The study's log is
+#   written to study.log and its progress, as JSON lines, to
+#   progress.jsonl in that directory.  Batch events are printed as JSON
+#   lines and appended to OUTPUT_DIR/batch_progress.jsonl.  A failed
+#   study is recorded and the batch continues with the next one.
+
+import os
+import sys
+import argparse
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+def is_bundled():
+    return getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS')
+
+def get_lib_path():
+    if is_bundled():
+        return os.path.join(sys._MEIPASS, 'StroCoVess')
+    return os.path.dirname(os.path.realpath(__file__))+'/../lib'
+
+def get_atlas_path():
+    if is_bundled():
+        return os.path.join(sys._MEIPASS, 'StroCoVess', 'atlas')
+    return os.path.dirname(os.path.realpath(__file__))+'/atlas'
+
+
+sys.path.append(get_lib_path())
+from StroCoVess_Lib import *
+
+image_extensions = [".nii", ".nii.gz", ".mha", ".mhd", ".nrrd"]
+
+def is_image_file(filename):
+    return any(filename.lower().endswith(ext) for ext in image_extensions)
+
+def get_study_name(path):
+    name = os.path.basename(os.path.normpath(path))
+    for ext in image_extensions:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def get_study(path, name=None):
+    if name == None:
+        name = get_study_name(path)
+    if os.path.isdir(path):
+        filenames = sorted(os.path.join(path,fname)
+            for fname in os.listdir(path) if is_image_file(fname))
+        return {"name": name, "ctp_3d": filenames}
+    return {"name": name, "ctp_4d": path}
+
+def find_studies(studies_path):
+    studies = []
+    if os.path.isdir(studies_path):
+        for fname in sorted(os.listdir(studies_path)):
+            path = os.path.join(studies_path,fname)
+            if os.path.isdir(path) or is_image_file(fname):
+                studies.append(get_study(path))
+    elif studies_path.lower().endswith(".json"):
+        with open(studies_path,'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        for entry in manifest:
+            if "ctp_4d" in entry:
+                studies.append({"name": entry.get("name",
+                    get_study_name(entry["ctp_4d"])),
+                    "ctp_4d": entry["ctp_4d"]})
+            else:
+                studies.append({"name": entry["name"],
+                    "ctp_3d": sorted(entry["ctp_3d"])})
+    else:
+        with open(studies_path,'r') as manifest_file:
+            for line in manifest_file:
+                path = line.strip()
+                if len(path) > 0 and not path.startswith("#"):
+                    studies.append(get_study(path))
+
+    # Study names become output directory names, so they must be unique
+    names = [study["name"] for study in studies]
+    duplicates = sorted(set(name for name in names if names.count(name)>1))
+    if len(duplicates) > 0:
+        raise ValueError("Duplicate study names "+str(duplicates))
+    for study in studies:
+        if "ctp_3d" in study and len(study["ctp_3d"]) == 0:
+            raise ValueError("No images found for study "+study["name"])
+    return studies
+
+def write_json_line(json_file, entry):
+    json_file.write(json.dumps(entry)+"\n")
+    json_file.flush()
+
+def run_study(study, output_dirname, atlas_path, number_of_threads,
+              debug=False, **report_options):
+    # report_options are passed to scv_generate_4d_ctp_vessel_report or
+    #   scv_generate_3d_ctp_vessel_report
+    study_dirname = os.path.join(output_dirname,study["name"])
+    os.makedirs(study_dirname,exist_ok=True)
+    log_file = open(os.path.join(study_dirname,"study.log"),'a')
+    progress_file = open(os.path.join(study_dirname,"progress.jsonl"),'a')
+
+    # ITK and the perfusion toolbox write to the process's stdout and
+    #   stderr, so both are sent to the study log
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    os.dup2(log_file.fileno(),1)
+    os.dup2(log_file.fileno(),2)
+
+    def make_report(level):
+        def report(label, percent):
+            print(level+": "+str(label)+" ("+str(int(percent))+"%)",
+                flush=True)
+            write_json_line(progress_file,{"time": time.time(),
+                "study": study["name"], "level": level,
+                "label": str(label), "percent": float(percent)})
+        return report
+
+    start_time = time.time()
+    result = {"study": study["name"], "status": "done", "error": None}
+    try:
+        # ITK threads and the study's own worker pools (registration,
+        #   seed extraction, map resampling) share the study's cores
+        scv_set_number_of_cores(number_of_threads)
+        if "ctp_4d" in study:
+            scv_generate_4d_ctp_vessel_report(study["ctp_4d"],
+                atlas_path, study_dirname,
+                make_report("progress"), make_report("subprogress"),
+                debug, **report_options)
+        else:
+            scv_generate_3d_ctp_vessel_report(list(study["ctp_3d"]),
+                atlas_path, study_dirname,
+                make_report("progress"), make_report("subprogress"),
+                debug, **report_options)
+    except Exception as error:
+        traceback.print_exc()
+        result["status"] = "failed"
+        result["error"] = repr(error)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_stdout,1)
+        os.dup2(saved_stderr,2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+        log_file.close()
+        progress_file.close()
+    result["elapsed"] = time.time()-start_time
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate CTP vessel reports for many studies.")
+    parser.add_argument("studies",
+        help="Directory of studies, or a manifest file (.json or text)")
+    parser.add_argument("-o","--output-dir",required=True,
+        help="Output directory; each study is written to a subdirectory")
+    parser.add_argument("-j","--workers",type=int,default=1,
+        help="Number of studies processed at the same time")
+    parser.add_argument("--threads",type=int,default=None,
+        help="Cores per worker, for ITK threads and the study's own "+
+            "worker processes (default: cores / workers)")
+    parser.add_argument("--atlas-path",default=get_atlas_path(),
+        help="Directory containing the brainweb atlas")
+    parser.add_argument("--force-stage",action="append",default=None,
+        choices=CTP_StageCache.stages+["all"],
+        help="Rerun a report stage even if its cached outputs are "+
+            "valid (may be repeated)")
+    parser.add_argument("--no-stage-cache",action="store_true",
+        help="Do not reuse or record stage outputs")
+    parser.add_argument("--transform-cache",action="store_true",
+        help="Reuse registration transforms recorded in the study's "+
+            "transform_cache directory")
+    parser.add_argument("--perfusion-backend",default="matlab",
+        choices=["matlab","numpy"],
+        help="Compute perfusion maps with the MATLAB perfusion toolbox "+
+            "or with NumPy")
+    parser.add_argument("--perfusion-tr",type=float,default=1.55,
+        help="Time between CTP frames in seconds, for the numpy "+
+            "perfusion backend (the toolbox always uses 1.55)")
+    parser.add_argument("--perfusion-map",action="append",default=None,
+        choices=list(scv_perfusion_map_properties),
+        help="Perfusion map sampled onto the vessels (may be repeated; "+
+            "must include ttp; default: "+
+            ",".join(scv_default_perfusion_maps)+")")
+    parser.add_argument("--perfusion-sampler",default="tubemath",
+        choices=["tubemath","numpy"],
+        help="Sample the perfusion maps at the vessels with TubeMath "+
+            "after resampling them onto the atlas, or at their own "+
+            "resolution with NumPy (faster; values differ slightly)")
+    parser.add_argument("--vessel-model",default=None,
+        help="Vessel enhancement model file (.npz)")
+    parser.add_argument("--vessel-model-mode",default="train",
+        choices=["train","pretrained"],
+        help="Train vessel enhancement on each study (saving the model "+
+            "if --vessel-model is given) or use the pretrained model")
+    parser.add_argument("--slab-size",type=int,default=None,
+        help="Reduce CTP frames to the CTA/DSA in slabs of this many "+
+            "slices, keeping the reduction on disk (default: in memory)")
+    parser.add_argument("--registration-workers",type=int,default=1,
+        help="Processes registering CTP frames within each study")
+    parser.add_argument("--warm-start",action="store_true",
+        help="Start each frame's registration from the previous frame's "+
+            "transform")
+    parser.add_argument("--motion-tolerance",type=float,default=None,
+        help="Skip registering frames whose residual motion is below "+
+            "this, e.g., 0.003 (default: register every frame)")
+    parser.add_argument("--pyramid-shrink-factor",type=int,
+        action="append",default=None,
+        help="Shrink factor of a CTP registration pyramid level, "+
+            "coarsest first (may be repeated)")
+    parser.add_argument("--atlas-shrink-factor",type=int,
+        action="append",default=None,
+        help="Shrink factor of an atlas registration pyramid level, "+
+            "coarsest first (may be repeated)")
+    parser.add_argument("--debug",action="store_true")
+    args = parser.parse_args(argv)
+    if args.vessel_model_mode == "pretrained" and args.vessel_model == None:
+        parser.error("--vessel-model is required in pretrained mode")
+    if args.perfusion_map != None and "ttp" not in args.perfusion_map:
+        parser.error("--perfusion-map must include ttp, which the region "+
+            "stats are binned by")
+    if args.vessel_model != None:
+        args.vessel_model = os.path.realpath(args.vessel_model)
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    studies = find_studies(args.studies)
+    output_dirname = os.path.realpath(args.output_dir)
+    os.makedirs(output_dirname,exist_ok=True)
+    num_workers = max(1,min(args.workers,len(studies)))
+    number_of_threads = args.threads
+    if number_of_threads == None:
+        number_of_threads = max(1,(os.cpu_count() or 1)//num_workers)
+
+    batch_file = open(os.path.join(output_dirname,"batch_progress.jsonl"),
+        'a')
+    def report_event(entry):
+        entry = dict(entry,time=time.time())
+        write_json_line(sys.stdout,entry)
+        write_json_line(batch_file,entry)
+
+    report_event({"event": "start", "studies": len(studies),
+        "workers": num_workers, "threads": number_of_threads})
+    start_time = time.time()
+    results = []
+    # Each study runs in a fresh, spawned process, so memory held by one
+    #   study is released before the next one starts.  The pool of one
+    #   process per study does what max_tasks_per_child=1 does, which
+    #   needs Python 3.11.
+    report_options = {"use_stage_cache": not args.no_stage_cache,
+        "force_stages": args.force_stage,
+        "perfusion_backend": args.perfusion_backend,
+        "vessel_model_filename": args.vessel_model,
+        "vessel_model_mode": args.vessel_model_mode,
+        "perfusion_maps": args.perfusion_map,
+        "perfusion_sampler": args.perfusion_sampler,
+        "perfusion_tr": args.perfusion_tr,
+        "slab_size": args.slab_size,
+        "num_workers": args.registration_workers,
+        "warm_start": args.warm_start,
+        "motion_tolerance": args.motion_tolerance,
+        "pyramid_shrink_factors": args.pyramid_shrink_factor,
+        "atlas_shrink_factors": args.atlas_shrink_factor,
+        "use_transform_cache": args.transform_cache}
+    context = multiprocessing.get_context("spawn")
+    pending_studies = list(studies)
+    running = {}
+    while len(pending_studies) > 0 or len(running) > 0:
+        while len(pending_studies) > 0 and len(running) < num_workers:
+            study = pending_studies.pop(0)
+            pool = ProcessPoolExecutor(max_workers=1,mp_context=context)
+            future = pool.submit(run_study,study,output_dirname,
+                args.atlas_path,number_of_threads,args.debug,
+                **report_options)
+            running[future] = (study,pool)
+        done,not_done = wait(running,return_when=FIRST_COMPLETED)
+        for future in done:
+            study,pool = running.pop(future)
+            pool.shutdown()
+            try:
+                result = future.result()
+            except Exception as error:
+                # The worker process itself died (e.g., out of memory)
+                result = {"study": study["name"], "status": "failed",
+                    "error": repr(error), "elapsed": None}
+            results.append(result)
+            report_event(dict(result,event="study",
+                completed=len(results),total=len(studies)))
+    elapsed = time.time()-start_time
+
+    num_done = sum(1 for result in results if result["status"] == "done")
+    num_failed = len(results)-num_done
+    study_times = [result["elapsed"] for result in results
+        if result["status"] == "done"]
+    summary = {"event": "summary",
+        "studies": len(results),
+        "done": num_done,
+        "failed": num_failed,
+        "failed_studies": [result["study"] for result in results
+            if result["status"] != "done"],
+        "elapsed": elapsed,
+        "studies_per_hour": num_done*3600/max(elapsed,1e-9),
+        "mean_study_time": sum(study_times)/max(len(study_times),1)}
+    report_event(summary)
+    batch_file.close()
+
+    print("Processed "+str(len(results))+" studies in "+
+        "{:.1f}".format(elapsed/60)+" minutes: "+str(num_done)+" done, "+
+        str(num_failed)+" failed", file=sys.stderr)
+    print("Throughput: {:.2f} studies/hour, ".format(
+        summary["studies_per_hour"])+"{:.1f} minutes/study".format(
+        summary["mean_study_time"]/60), file=sys.stderr)
+    for name in summary["failed_studies"]:
+        print("  Failed: "+name, file=sys.stderr)
+
+    if num_failed > 0:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
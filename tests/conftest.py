@@ -0,0 +1,25 @@
+import os
+import sys
+
+import numpy as np
+
+import itk
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    '..','lib'))
+
+
+def make_image(arr, spacing=(1.0,1.0,1.0), origin=(0.0,0.0,0.0)):
+    im = itk.GetImageFromArray(np.ascontiguousarray(arr,dtype=np.float32))
+    im.SetSpacing(spacing)
+    im.SetOrigin(origin)
+    return im
+
+def quiet(label, percent):
+    pass
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+import itk
+
+import pytest
+
+from conftest import make_image
+from StroCoVess_Lib import CTP_ArtifactWriter, CTP_ArtifactWriteError
+
+
+def test_images_are_written_from_their_hand_off(rng, tmp_path):
+    dirname = str(tmp_path)
+    arr = rng.normal(0,1,(6,7,8))
+    im = make_image(arr,spacing=(0.5,1.0,2.0),origin=(1.0,-2.0,3.0))
+    im.SetDirection(itk.GetMatrixFromArray(np.array([[0,1,0],[-1,0,0],
+        [0,0,1]],dtype=np.float64)))
+    mask_im = itk.GetImageFromArray((arr > 0).astype(np.uint8))
+    writer = CTP_ArtifactWriter()
+    try:
+        writer.write_image(im,os.path.join(dirname,"im.mha"))
+        writer.write_image(mask_im,os.path.join(dirname,"mask.nii.gz"))
+        # The image may be changed once it is handed off
+        itk.array_view_from_image(im)[:] = 0
+        writer.flush()
+    finally:
+        writer.close()
+
+    written_im = itk.imread(os.path.join(dirname,"im.mha"))
+    assert np.array_equal(itk.GetArrayFromImage(written_im),
+        arr.astype(np.float32))
+    assert np.allclose(written_im.GetSpacing(),(0.5,1.0,2.0))
+    assert np.allclose(written_im.GetOrigin(),(1.0,-2.0,3.0))
+    assert np.allclose(itk.array_from_matrix(written_im.GetDirection()),
+        itk.array_from_matrix(im.GetDirection()))
+    written_mask_arr = itk.GetArrayFromImage(itk.imread(os.path.join(
+        dirname,"mask.nii.gz")))
+    assert written_mask_arr.dtype == np.uint8
+    assert np.array_equal(written_mask_arr,arr > 0)
+    assert sorted(os.listdir(dirname)) == ["im.mha","mask.nii.gz"]
+
+def test_failed_writes_are_reported_by_file(tmp_path):
+    dirname = str(tmp_path)
+    filename = os.path.join(dirname,"missing","im.mha")
+    writer = CTP_ArtifactWriter()
+    try:
+        writer.write_image(make_image(np.ones((4,4,4))),filename)
+        writer.write_image(make_image(np.ones((4,4,4))),
+            os.path.join(dirname,"im.mha"))
+        with pytest.raises(CTP_ArtifactWriteError) as error:
+            writer.flush()
+    finally:
+        writer.close()
+    assert list(error.value.errors) == [filename]
+    assert os.listdir(dirname) == ["im.mha"]
@@ -0,0 +1,71 @@
+import numpy as np
+
+import itk
+
+from conftest import make_image, quiet
+from StroCoVess_Lib import scv_compute_atlas_region_stats, \
+    scv_compute_atlas_region_stats_multi
+
+
+def reference_atlas_region_stats(atlas_im, time_im, vess_im,
+                                 number_of_time_bins=100):
+    # The per-voxel loop of the original scv_compute_atlas_region_stats
+    atlas_arr = itk.GetArrayFromImage(atlas_im)
+    time_arr = itk.GetArrayFromImage(time_im)
+    vess_arr = itk.GetArrayFromImage(vess_im)
+
+    num_regions = int(atlas_arr.max())
+    time_max = float(time_arr.max())
+    time_min = float(time_arr.min())
+    nbins = int(number_of_time_bins)
+    time_factor = (time_max-time_min)/(nbins+1)
+
+    bin_value = np.zeros([num_regions,nbins])
+    bin_count = np.zeros([num_regions,nbins])
+    for atlas_region in range(num_regions):
+        indx_arr = np.where(atlas_arr==atlas_region)
+        for indx in zip(indx_arr[0],indx_arr[1],indx_arr[2]):
+            time_bin = int((time_arr[indx]-time_min)/time_factor)
+            time_bin = min(max(0,time_bin),nbins-1)
+            if np.isnan(vess_arr[indx]) == False:
+                bin_count[atlas_region,time_bin] += 1
+                bin_value[atlas_region,time_bin] += vess_arr[indx]
+
+    bin_label = np.arange(nbins) * time_factor - time_min
+    bin_value = np.divide(bin_value,bin_count,out=bin_value,
+        where=bin_count!=0)
+    return bin_label,bin_value,bin_count
+
+def make_stats_images(rng, shape=(12,16,20), num_regions=5):
+    atlas_arr = rng.integers(0,num_regions+1,shape).astype(np.float32)
+    time_arr = rng.uniform(0,40,shape).astype(np.float32)
+    value_arrs = []
+    for i in range(3):
+        value_arr = rng.normal(50,10,shape).astype(np.float32)
+        value_arr[rng.random(shape)<0.05] = np.nan
+        value_arrs.append(value_arr)
+    return make_image(atlas_arr),make_image(time_arr), \
+        [make_image(value_arr) for value_arr in value_arrs]
+
+def test_bincount_stats_match_original_loop(rng):
+    atlas_im,time_im,value_ims = make_stats_images(rng)
+    for number_of_time_bins in [100,7]:
+        expected = reference_atlas_region_stats(atlas_im,time_im,
+            value_ims[0],number_of_time_bins)
+        bin_label,bin_value,bin_count = scv_compute_atlas_region_stats(
+            atlas_im,time_im,value_ims[0],number_of_time_bins,quiet)
+        assert np.allclose(bin_label,expected[0])
+        assert np.array_equal(bin_count,expected[2])
+        assert np.allclose(bin_value,expected[1])
+
+def test_multi_stats_match_single_map_stats(rng):
+    atlas_im,time_im,value_ims = make_stats_images(rng)
+    bin_label,bin_values,bin_counts = scv_compute_atlas_region_stats_multi(
+        atlas_im,time_im,{"A": value_ims[0],"B": value_ims[1],
+        "C": value_ims[2]},100,quiet)
+    for name,value_im in zip(["A","B","C"],value_ims):
+        single = scv_compute_atlas_region_stats(atlas_im,time_im,value_im,
+            100,quiet)
+        assert np.array_equal(bin_label,single[0])
+        assert np.array_equal(bin_values[name],single[1])
+        assert np.array_equal(bin_counts[name],single[2])
@@ -0,0 +1,78 @@
+import csv
+import os
+
+import numpy as np
+
+import itk
+
+from conftest import make_image, quiet
+from StroCoVess_Lib import scv_prepare_ctp_registration_fixed_image
+from StroCoVess_Lib import scv_compute_ctp_registration_score
+from StroCoVess_Lib import scv_register_ctp_images
+
+
+def make_head(rng, shift=0.0, contrast=0.0, size=64):
+    # Bone shell around textured brain with vessels, translated by shift
+    #   voxels along x, with 10 HU noise
+    shape = [size//2,size,size]
+    z,y,x = np.meshgrid(*[np.arange(n,dtype=np.float64)-n/2 for n in shape],
+        indexing='ij')
+    x = x-shift
+    r = np.sqrt((x/(0.45*size))**2+(y/(0.38*size))**2+(z/(0.4*size))**2)
+    arr = np.full(shape,-1000.0)
+    brain = r < 0.9
+    arr[brain] = 35+8*np.sin(x[brain]/3.1)*np.cos(y[brain]/4.3)+ \
+        25*contrast
+    vessels = brain & (np.abs(np.sin(x/7.0+y/11.0)) < 0.08)
+    arr[vessels] += 60+250*contrast
+    bone = (r >= 0.9) & (r < 1.0)
+    arr[bone] = 450+150*np.sin(x[bone]/5.0+z[bone]/3.0)
+    return make_image(arr+rng.normal(0,10,shape))
+
+
+def test_registration_score_separates_misaligned_frames(rng):
+    fixed_im,mask_obj = scv_prepare_ctp_registration_fixed_image(
+        make_head(rng),quiet)
+    identity_tfm = itk.AffineTransform[itk.D,3].New()
+    def score(moving_im):
+        return scv_compute_ctp_registration_score(fixed_im,mask_obj,
+            moving_im,identity_tfm)
+    # The default warm_start_tolerance, 0.95, accepts aligned frames even
+    #   at the bolus peak and rejects a one voxel offset
+    assert score(make_head(rng,contrast=1.0)) > 0.99
+    assert score(make_head(rng,shift=1.0)) < 0.95
+    assert score(make_head(rng,shift=1.0)) > score(make_head(rng,shift=2.0))
+
+def test_motion_gate_registers_shifted_frames(rng, tmp_path):
+    filenames = []
+    for i,(shift,contrast) in enumerate([(0,0),(0,1),(0.5,0),(3,1)]):
+        filenames.append(os.path.join(str(tmp_path),"CTP{}.mha".format(i)))
+        itk.imwrite(make_head(rng,shift,contrast),filenames[-1])
+    scv_register_ctp_images(0,filenames,str(tmp_path),quiet,
+        motion_tolerance=0.003,use_transform_cache=False,
+        write_frames=False)
+    with open(os.path.join(str(tmp_path),"ctp_registration_log.csv")) \
+            as log_file:
+        status = [row["Status"] for row in csv.DictReader(log_file)]
+    # Only the aligned frame is skipped, even at the bolus peak
+    assert status == ["fixed","skipped","registered","registered"]
+
+def test_parallel_registration_gates_frames_as_serial(rng, tmp_path,
+                                                     monkeypatch):
+    import StroCoVess_Lib
+    # Workers are only started when there are cores for them
+    monkeypatch.setattr(StroCoVess_Lib,"scv_number_of_cores",2)
+    filenames = []
+    for i,(shift,contrast) in enumerate([(0,0),(0,1),(0.5,0),(3,1)]):
+        filenames.append(os.path.join(str(tmp_path),"CTP{}.mha".format(i)))
+        itk.imwrite(make_head(rng,shift,contrast),filenames[-1])
+    dirname = os.path.join(str(tmp_path),"out")
+    os.makedirs(dirname)
+    scv_register_ctp_images(0,filenames,dirname,quiet,
+        motion_tolerance=0.003,use_transform_cache=False,num_workers=2)
+    with open(os.path.join(dirname,"ctp_registration_log.csv")) \
+            as log_file:
+        status = [row["Status"] for row in csv.DictReader(log_file)]
+    assert status == ["fixed","skipped","registered","registered"]
+    assert len([filename for filename in os.listdir(dirname)
+        if filename.endswith("_reg.nii")]) == 4
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+
+import itk
+
+from conftest import make_image, quiet
+from StroCoVess_Lib import CTP_CTAReduction, scv_convert_ctp_to_cta
+from StroCoVess_Lib import CTP_FrameSource
+
+
+def reference_ctp_to_cta(arrays, base_num):
+    # The per-frame loop of the original scv_convert_ctp_to_cta
+    imdatamax = arrays[base_num]
+    imdatamin = imdatamax
+    for arr in arrays:
+        imdatamax = np.maximum(imdatamax,arr)
+        arr = np.where(arr==-1024,imdatamin,arr)
+        imdatamin = np.minimum(imdatamin,arr)
+    diff = imdatamax-imdatamin
+    diff[:4,:,:] = 0
+    diff[-4:,:,:] = 0
+    diff[:,:4,:] = 0
+    diff[:,-4:,:] = 0
+    diff[:,:,:4] = 0
+    diff[:,:,-4:] = 0
+    return imdatamin,imdatamax,diff
+
+def make_frames(rng, num_frames=5, shape=(20,24,28)):
+    arrays = [rng.normal(40,30,shape).astype(np.float32)
+        for i in range(num_frames)]
+    for arr in arrays:
+        arr[rng.random(shape)<0.05] = -1024
+    return arrays
+
+def write_frames(arrays, dirname):
+    filenames = []
+    for i,arr in enumerate(arrays):
+        filenames.append(os.path.join(dirname,"CTP{:02}.mha".format(i)))
+        itk.imwrite(make_image(arr),filenames[-1])
+    return filenames
+
+def test_reduction_matches_original_loop(rng):
+    arrays = make_frames(rng)
+    expected = reference_ctp_to_cta(arrays,len(arrays)//2)
+    for slab_size in [None,1,7,100]:
+        reduction = CTP_CTAReduction(slab_size=slab_size)
+        # Frames may arrive in any order
+        for i in [3,0,4,2,1]:
+            reduction.add_frame(make_image(arrays[i]),i==len(arrays)//2)
+        for im,expected_arr in zip(reduction.get_images(),expected):
+            assert np.array_equal(itk.GetArrayViewFromImage(im),
+                expected_arr)
+
+def test_slab_and_full_cta_are_identical(rng, tmp_path):
+    arrays = make_frames(rng)
+    filenames = write_frames(arrays,str(tmp_path))
+    # A frame on another grid is resampled onto the base frame's grid
+    itk.imwrite(make_image(arrays[0][:,::2,::2],spacing=(2.0,2.0,1.0)),
+        filenames[0])
+    full_images = scv_convert_ctp_to_cta(list(filenames),quiet,
+        output_dirname=str(tmp_path))
+    slab_images = scv_convert_ctp_to_cta(list(filenames),quiet,
+        output_dirname=str(tmp_path),slab_size=3)
+    for full_im,slab_im in zip(full_images,slab_images):
+        assert np.array_equal(itk.GetArrayViewFromImage(full_im),
+            itk.GetArrayViewFromImage(slab_im))
+        assert full_im.GetSpacing() == slab_im.GetSpacing()
+        assert full_im.GetOrigin() == slab_im.GetOrigin()
+
+class CountingFrameSource(CTP_FrameSource):
+    def __init__(self, filenames):
+        super().__init__(filenames,look_ahead=0)
+        self.reads = []
+
+    def read_frame(self, index):
+        self.reads.append(index)
+        return super().read_frame(index)
+
+def test_each_frame_is_read_once(rng, tmp_path):
+    arrays = make_frames(rng)
+    frames = CountingFrameSource(write_frames(arrays,str(tmp_path)))
+    images = scv_convert_ctp_to_cta(frames,quiet,
+        output_dirname=str(tmp_path),slab_size=3)
+    assert sorted(frames.reads) == list(range(len(arrays)))
+    for im,expected_arr in zip(images,reference_ctp_to_cta(arrays,
+            len(arrays)//2)):
+        assert np.array_equal(itk.GetArrayViewFromImage(im),expected_arr)
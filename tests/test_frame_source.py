@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+
+import itk
+
+from conftest import make_image
+from StroCoVess_Lib import CTP_FrameSource, CTP_4DFrameSource
+
+
+def test_reader_process_returns_frames_in_order(rng, tmp_path):
+    filenames = []
+    for i in range(4):
+        filenames.append(os.path.join(str(tmp_path),"CTP{}.mha".format(i)))
+        itk.imwrite(make_image(rng.normal(0,1,(6,7,8)),
+            spacing=(0.5,0.5,2.0),origin=(1.0,2.0,3.0)),filenames[-1],
+            compression=True)
+    order = [2,0,3,1]
+    frames = list(CTP_FrameSource(filenames,look_ahead=0).iter_frames(order))
+    prefetched = list(CTP_FrameSource(filenames,
+        look_ahead=2).iter_frames(order))
+    assert len(prefetched) == len(order)
+    for frame,prefetched_frame in zip(frames,prefetched):
+        assert np.array_equal(itk.GetArrayViewFromImage(frame),
+            itk.GetArrayViewFromImage(prefetched_frame))
+        assert frame.GetSpacing() == prefetched_frame.GetSpacing()
+        assert frame.GetOrigin() == prefetched_frame.GetOrigin()
+
+def test_memory_cap_limits_look_ahead(rng, tmp_path):
+    filename = os.path.join(str(tmp_path),"CTP.mha")
+    itk.imwrite(make_image(np.zeros((64,64,64))),filename)
+    # One frame is 1 MB
+    assert CTP_FrameSource([filename]*4,look_ahead=3,
+        max_memory_mb=2).get_depth() == 2
+
+def test_preloaded_4d_frames_are_not_read_ahead(rng, tmp_path):
+    filename = os.path.join(str(tmp_path),"CTP_4D.nii.gz")
+    arr = rng.normal(0,1,(3,5,6,7)).astype(np.float32)
+    itk.imwrite(itk.GetImageFromArray(arr),filename,compression=True)
+    frames = CTP_4DFrameSource(filename,look_ahead=2)
+    assert frames.preload
+    assert frames.get_depth() == 0
+    for i,frame in enumerate(frames):
+        assert np.array_equal(itk.GetArrayViewFromImage(frame),arr[i])
@@ -0,0 +1,35 @@
+import os
+import stat
+import time
+
+from StroCoVess_Lib import scv_submit_perfusion_backend
+
+
+def test_terminating_the_perfusion_pool_stops_matlab(tmp_path, monkeypatch):
+    # A stand-in for matlab that records its pid and never finishes
+    dirname = str(tmp_path)
+    pid_filename = os.path.join(dirname,"matlab.pid")
+    matlab_filename = os.path.join(dirname,"matlab")
+    with open(matlab_filename,'w') as matlab_file:
+        matlab_file.write("#!/bin/sh\necho $$ > "+pid_filename+
+            "\nexec sleep 60\n")
+    os.chmod(matlab_filename,os.stat(matlab_filename).st_mode|stat.S_IXUSR)
+    monkeypatch.setenv("PATH",dirname+os.pathsep+os.environ["PATH"])
+
+    pool,result = scv_submit_perfusion_backend("matlab","ctp.nii",
+        "mask.nii",dirname,{})
+    start = time.time()
+    while not os.path.exists(pid_filename) and time.time()-start < 60:
+        time.sleep(0.1)
+    time.sleep(0.2)
+    with open(pid_filename) as pid_file:
+        pid = int(pid_file.read())
+    pool.terminate()
+    pool.join()
+    assert not result.ready() or not result.successful()
+    try:
+        os.kill(pid,0)
+        running = True
+    except ProcessLookupError:
+        running = False
+    assert not running
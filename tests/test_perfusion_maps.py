@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+
+import itk
+
+from conftest import make_image
+from StroCoVess_Lib import scv_compute_perfusion_maps, scv_gamma_variate
+
+
+def make_ctp(rng, tr, cbf, mtt, delay):
+    # 4D CTP of 40 frames and 3 slices.  The middle slice (the AIF
+    #   slice) holds gamma variate AIFs of slightly varying amplitude.
+    #   Slice 0 and 2 hold tissue curves, the AIF convolved with
+    #   cbf*exp(-t/mtt) on a fine grid and delayed by delay seconds: the
+    #   left half of a slice with cbf[0], the right half with cbf[1].
+    num_times = 40
+    shape = (3,40,40)
+    fine_dt = 0.01
+    fine_time = np.arange(int(num_times*tr/fine_dt))*fine_dt
+    aif_parameters = [8.0,3.0,1.5,300/(4.5**3*np.exp(-3))]
+    fine_aif = scv_gamma_variate(aif_parameters,fine_time)
+    time = np.arange(num_times)*tr
+    aif = np.interp(time,fine_time,fine_aif)
+    ctp = np.full((num_times,)+shape,40.0)
+    ctp[:,1] += aif[:,None,None]*rng.uniform(0.98,1.02,shape[1:])
+    tissue = []
+    for flow in cbf:
+        fine_tissue = flow*np.convolve(fine_aif,
+            np.exp(-fine_time/mtt))[:len(fine_time)]*fine_dt
+        tissue.append(np.interp(time-delay,fine_time,fine_tissue,left=0))
+    for s in [0,2]:
+        ctp[:,s,:,:20] += tissue[0][:,None,None]
+        ctp[:,s,:,20:] += tissue[1][:,None,None]
+    ctp += rng.normal(0,0.01,ctp.shape)
+    return ctp,tissue
+
+
+def compute_maps(rng, dirname, tr, cbf, mtt, delay, method=None):
+    ctp,tissue = make_ctp(rng,tr,cbf,mtt,delay)
+    os.makedirs(dirname,exist_ok=True)
+    ctp_filename = os.path.join(dirname,"CTP_4D.nii")
+    itk.imwrite(itk.GetImageFromArray(ctp.astype(np.float32)),ctp_filename)
+    mask_filename = os.path.join(dirname,"mask.nii")
+    itk.imwrite(make_image(np.ones(ctp.shape[1:])),mask_filename)
+    options = {}
+    if method != None:
+        options["deconvolution_method"] = method
+    filenames = scv_compute_perfusion_maps(ctp_filename,mask_filename,
+        dirname,tr=tr,chunk_size=1000,**options)
+    maps = [itk.GetArrayFromImage(itk.imread(filename))
+        for filename in filenames]
+    return [os.path.basename(filename) for filename in filenames],maps,tissue
+
+
+def test_numpy_perfusion_recovers_known_curves(rng, tmp_path):
+    tr = 2.0
+    mtt = 4.0
+    cbf = [0.01,0.02]
+    names,maps,tissue = compute_maps(rng,os.path.join(str(tmp_path),"0"),
+        tr,cbf,mtt,0,"csvd")
+    assert names == ["CBF_cSVD.nii","CBV.nii","MTT_cSVD.nii",
+        "Tmax_cSVD.nii","TTP.nii"]
+    cbf_arr,cbv_arr,mtt_arr,tmax_arr,ttp_arr = maps
+    names,delayed_maps,delayed_tissue = compute_maps(rng,
+        os.path.join(str(tmp_path),"1"),tr,cbf,mtt,2*tr,"csvd")
+    delayed_tmax_arr = delayed_maps[3]
+    delayed_ttp_arr = delayed_maps[4]
+
+    for s in [0,2]:
+        for half,flow,k in [(slice(0,20),cbf[0],0),(slice(20,40),cbf[1],1)]:
+            # CBV is the ratio of the tissue and AIF areas, so it only
+            #   depends on the AIF's amplitude, which varies by 2%
+            assert np.allclose(cbv_arr[s,:,half],flow*mtt,rtol=0.05)
+            # Truncated SVD underestimates the residue's peak, by about
+            #   a third at this frame interval
+            assert np.all(cbf_arr[s,:,half] > 0.5*flow)
+            assert np.all(cbf_arr[s,:,half] < flow)
+            assert np.all(ttp_arr[s,:,half] == np.argmax(tissue[k])+1)
+            assert np.all(delayed_ttp_arr[s,:,half] ==
+                np.argmax(delayed_tissue[k])+1)
+            # Tmax follows the tissue's delay relative to the AIF
+            assert np.all(delayed_tmax_arr[s,:,half] ==
+                tmax_arr[s,:,half]+2)
+    assert np.allclose(cbf_arr[0,:,20:].mean()/cbf_arr[0,:,:20].mean(),2,
+        rtol=0.02)
+
+def test_default_maps_are_named_as_the_toolbox(rng, tmp_path):
+    # The default method is the toolbox's, so either backend writes the
+    #   files that the report looks up
+    names,maps,tissue = compute_maps(rng,str(tmp_path),1.55,[0.01,0.02],
+        4.0,0)
+    assert names == ["CBF_SVD.nii","CBV.nii","MTT_SVD.nii","Tmax_SVD.nii",
+        "TTP.nii"]
+
+def test_3d_frames_give_the_4d_maps(rng, tmp_path):
+    dirname = str(tmp_path)
+    names,maps,tissue = compute_maps(rng,dirname,1.55,[0.01,0.02],4.0,0)
+    ctp_arr = itk.GetArrayFromImage(itk.imread(os.path.join(dirname,
+        "CTP_4D.nii")))
+    frame_filenames = []
+    for t in range(ctp_arr.shape[0]):
+        frame_filenames.append(os.path.join(dirname,"CTP{}.mha".format(t)))
+        itk.imwrite(make_image(ctp_arr[t]),frame_filenames[-1])
+    frames_dirname = os.path.join(dirname,"frames")
+    os.makedirs(frames_dirname)
+    filenames = scv_compute_perfusion_maps(frame_filenames,
+        os.path.join(dirname,"mask.nii"),frames_dirname,tr=1.55,
+        chunk_size=1000)
+    for filename,arr in zip(filenames,maps):
+        assert np.array_equal(itk.GetArrayFromImage(itk.imread(filename)),
+            arr)
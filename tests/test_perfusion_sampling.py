@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+
+import pytest
+
+import itk
+from itk import TubeTK as tube
+
+from conftest import make_image, quiet
+from StroCoVess_Lib import scv_tube_from_arrays, scv_tube_point_scalars
+from StroCoVess_Lib import scv_resample_perfusion_maps
+from StroCoVess_Lib import scv_sample_perfusion_maps
+from StroCoVess_Lib import scv_sample_perfusion_maps_at_tubes
+from StroCoVess_Lib import scv_sample_images_at_points
+from StroCoVess_Lib import scv_compute_atlas_region_stats_multi
+from StroCoVess_Lib import scv_compute_atlas_region_stats_from_maps
+from StroCoVess_Lib import scv_generate_vessel_report
+
+
+# Straight tubes of radius 1.5 as (start, direction) in (x,y,z) voxels of
+#   the 1 mm atlas
+tube_lines = [((5,20,20),(1,0,0)),((20,10,5),(0,0,1)),((15,5,20),(0.3,1,0))]
+
+def make_tube_group():
+    tube_group = itk.GroupSpatialObject[3].New()
+    for tube_id,(start,direction) in enumerate(tube_lines):
+        direction = np.array(direction,dtype=np.float64)
+        direction /= np.linalg.norm(direction)
+        positions = np.array(start)+np.arange(30)[:,None]*direction
+        arrays = {"Id": tube_id, "ParentId": -1,
+            "Radius": np.full(len(positions),1.5),
+            "Position": positions,
+            "Tangent": np.tile(direction,(len(positions),1)),
+            "Normal1": np.zeros(positions.shape),
+            "Normal2": np.zeros(positions.shape)}
+        for name in scv_tube_point_scalars:
+            arrays[name] = np.zeros(len(positions))
+        tube_group.AddChild(scv_tube_from_arrays(arrays))
+    tube_group.Update()
+    return tube_group
+
+def make_atlas():
+    # Three regions along x, and the tubes' voxels labeled 4
+    shape = (40,40,40)
+    z,y,x = np.meshgrid(*[np.arange(n,dtype=np.float64) for n in shape],
+        indexing='ij')
+    atlas_arr = np.where(x < 13,1,np.where(x < 26,2,3)).astype(np.float32)
+    for start,direction in tube_lines:
+        direction = np.array(direction,dtype=np.float64)
+        direction /= np.linalg.norm(direction)
+        for position in np.array(start)+np.arange(30)[:,None]*direction:
+            atlas_arr[(x-position[0])**2+(y-position[1])**2+
+                (z-position[2])**2 < 1.5**2] = 4
+    return make_image(atlas_arr)
+
+def make_maps(dirname):
+    # Smooth maps on a coarser grid, offset from the atlas's
+    shape = (22,22,22)
+    z,y,x = np.meshgrid(*[np.arange(n,dtype=np.float64)*2-1 for n in shape],
+        indexing='ij')
+    map_arrs = {"TTP": 10+0.5*x+0.2*y,
+                "CBF": 50+10*np.sin(x/9)+5*np.cos(z/7),
+                "CBV": 3+0.005*x*y}
+    map_filenames = {}
+    for name,map_arr in map_arrs.items():
+        map_filenames[name] = os.path.join(dirname,name+".mha")
+        itk.imwrite(make_image(map_arr,spacing=(2.0,2.0,2.0),
+            origin=(-1.0,-1.0,-1.0)),map_filenames[name])
+    return map_filenames
+
+def get_point_values(tube_group, name):
+    children = tube_group.GetChildren(tube_group.GetMaximumDepth(),"Tube")
+    values = []
+    for i in range(len(children)):
+        tube_so = itk.down_cast(children[i])
+        values += [tube_so.GetPoint(j).GetTagScalarValue(name)
+            for j in range(tube_so.GetNumberOfPoints())]
+    return np.array(values)
+
+
+def test_numpy_sampler_matches_tubemath_sampler(tmp_path):
+    atlas_im = make_atlas()
+    map_filenames = make_maps(str(tmp_path))
+
+    tubemath_group = make_tube_group()
+    TubeMath = tube.TubeMath[3,itk.F].New()
+    TubeMath.SetInputTubeGroup(tubemath_group)
+    TubeMath.SetUseAllTubes()
+    TubeMath.ComputeTubeRegions(atlas_im)
+    resampled_ims = scv_resample_perfusion_maps(map_filenames,atlas_im,1)
+    scv_sample_perfusion_maps(TubeMath,resampled_ims,0,0)
+
+    numpy_group = make_tube_group()
+    map_ims = {name: itk.imread(filename,itk.F)
+        for name,filename in map_filenames.items()}
+    scv_sample_perfusion_maps_at_tubes(numpy_group,map_ims,atlas_im)
+
+    for name in map_filenames:
+        tubemath_values = get_point_values(tubemath_group,name)
+        numpy_values = get_point_values(numpy_group,name)
+        value_range = np.ptp(tubemath_values)
+        # Trilinear values against the resampled map's: within 3% of the
+        #   values' range
+        assert np.all(np.abs(numpy_values-tubemath_values) <
+            0.03*value_range)
+        # Rings against tube regions: within 3% of the range at the median
+        #   point, and 20% at any point that TubeMath gave a region to
+        tubemath_tissue = get_point_values(tubemath_group,name+"_Tissue")
+        numpy_tissue = get_point_values(numpy_group,name+"_Tissue")
+        in_region = tubemath_tissue != 0
+        assert in_region.mean() > 0.95
+        tissue_error = np.abs(numpy_tissue-tubemath_tissue)[in_region]
+        assert np.median(tissue_error) < 0.03*value_range
+        assert np.all(tissue_error < 0.2*value_range)
+
+    # The region stats of the two samplers are the same
+    tubemath_stats = scv_compute_atlas_region_stats_multi(atlas_im,
+        resampled_ims["TTP"],resampled_ims,100,quiet)
+    numpy_stats = scv_compute_atlas_region_stats_from_maps(atlas_im,"TTP",
+        map_ims,100,quiet)
+    assert np.allclose(tubemath_stats[0],numpy_stats[0])
+    for name in map_filenames:
+        assert np.allclose(tubemath_stats[1][name],numpy_stats[1][name])
+        assert np.array_equal(tubemath_stats[2][name],numpy_stats[2][name])
+
+def test_point_samples_match_itk_linear_interpolation(rng):
+    map_im = make_image(rng.normal(0,1,(9,10,11)),spacing=(0.7,1.1,2.0),
+        origin=(3.0,-2.0,1.0))
+    interpolator = itk.LinearInterpolateImageFunction.New(map_im)
+    points = rng.uniform([3.0,-2.0,1.0],[3.0+0.7*10,-2.0+1.1*9,1.0+2.0*8],
+        (200,3))
+    values = scv_sample_images_at_points({"map": map_im},points)["map"]
+    expected = [interpolator.Evaluate(point.tolist()) for point in points]
+    assert np.allclose(values,expected,atol=1e-5)
+
+def test_maps_are_resampled_alike_in_workers(tmp_path, monkeypatch):
+    import StroCoVess_Lib
+    atlas_im = make_atlas()
+    map_filenames = make_maps(str(tmp_path))
+    serial_ims = scv_resample_perfusion_maps(map_filenames,atlas_im,1)
+    # Workers are only started when there are cores for them
+    monkeypatch.setattr(StroCoVess_Lib,"scv_number_of_cores",2)
+    worker_ims = scv_resample_perfusion_maps(map_filenames,atlas_im,2)
+    assert list(worker_ims) == list(map_filenames)
+    for name in map_filenames:
+        assert np.array_equal(itk.GetArrayFromImage(worker_ims[name]),
+            itk.GetArrayFromImage(serial_ims[name]))
+        assert np.allclose(worker_ims[name].GetSpacing(),
+            atlas_im.GetSpacing())
+
+def test_map_lists_without_ttp_are_rejected(tmp_path):
+    # The region stats are binned by TTP, so a report without it is
+    #   rejected before any stage runs
+    with pytest.raises(ValueError,match="ttp"):
+        scv_generate_vessel_report([],"","","","","","",str(tmp_path),
+            perfusion_maps=["cbf"])
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,75 @@
+import json
+import os
+
+from StroCoVess_Lib import CTP_StageCache, scv_get_stage_parameters
+from StroCoVess_Lib import scv_enhance_vessels_in_cta
+from StroCoVess_Lib import scv_extract_vessels_from_cta
+
+
+def write_file(filename, text):
+    with open(filename,'w') as out_file:
+        out_file.write(text)
+
+def save_stage(dirname, input_filename, parameters, **kwargs):
+    cache = CTP_StageCache(dirname,**kwargs)
+    key = cache.get_key("enhance",[input_filename],parameters)
+    output_filename = os.path.join(dirname,"out.txt")
+    write_file(output_filename,"output")
+    cache.save("enhance",key,{"out": output_filename})
+    return output_filename
+
+def load_stage(dirname, input_filename, parameters, **kwargs):
+    cache = CTP_StageCache(dirname,**kwargs)
+    return cache.load("enhance",cache.get_key("enhance",[input_filename],
+        parameters))
+
+
+def test_stage_is_reused_until_inputs_or_parameters_change(tmp_path):
+    dirname = str(tmp_path)
+    input_filename = os.path.join(dirname,"in.txt")
+    write_file(input_filename,"input")
+    parameters = {"crop_to_roi": True}
+    output_filename = save_stage(dirname,input_filename,parameters)
+
+    assert load_stage(dirname,input_filename,parameters) == \
+        {"out": output_filename}
+    assert load_stage(dirname,input_filename,{"crop_to_roi": False}) == None
+    assert load_stage(dirname,input_filename,parameters,
+        force_stages=["enhance"]) == None
+    assert load_stage(dirname,input_filename,parameters,
+        enabled=False) == None
+    write_file(input_filename,"changed input")
+    assert load_stage(dirname,input_filename,parameters) == None
+
+def test_changed_output_or_version_invalidates_stage(tmp_path):
+    dirname = str(tmp_path)
+    input_filename = os.path.join(dirname,"in.txt")
+    write_file(input_filename,"input")
+    output_filename = save_stage(dirname,input_filename,{})
+    assert load_stage(dirname,input_filename,{}) != None
+
+    write_file(output_filename,"edited output")
+    assert load_stage(dirname,input_filename,{}) == None
+
+    output_filename = save_stage(dirname,input_filename,{})
+    manifest_filename = os.path.join(dirname,
+        CTP_StageCache.manifest_filename)
+    with open(manifest_filename) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest["version"] = CTP_StageCache.version-1
+    with open(manifest_filename,'w') as manifest_file:
+        json.dump(manifest,manifest_file)
+    assert load_stage(dirname,input_filename,{}) == None
+
+def test_stage_parameters_include_defaults():
+    parameters = scv_get_stage_parameters(scv_enhance_vessels_in_cta,
+        vessel_model_mode="pretrained")
+    assert parameters["vessel_model_mode"] == "pretrained"
+    assert parameters["crop_to_roi"] == True
+    assert parameters["roi_padding"] == 20
+    assert parameters["number_of_seeds"] == 15
+    for name in ["report_progress","debug","output_dirname"]:
+        assert name not in parameters
+    assert scv_get_stage_parameters(scv_extract_vessels_from_cta,
+        crop_to_roi=False)["crop_to_roi"] == False
+    json.dumps(parameters)
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+import itk
+
+from StroCoVess_Lib import CTP_TransformCache, scv_register_ctp_images
+from conftest import quiet
+from test_ctp_registration import make_head
+
+
+def test_key_depends_on_version_images_and_parameters(tmp_path):
+    cache = CTP_TransformCache(str(tmp_path))
+    key = cache.get_key("fixed","moving",{"max_iterations": 100})
+    assert key == cache.get_key("fixed","moving",{"max_iterations": 100})
+    assert key != cache.get_key("fixed","moving",{"max_iterations": 30})
+    assert key != cache.get_key("fixed","other",{"max_iterations": 100})
+    cache.version += 1
+    assert key != cache.get_key("fixed","moving",{"max_iterations": 100})
+
+def test_load_returns_saved_transform(tmp_path):
+    cache = CTP_TransformCache(str(tmp_path))
+    tfm = itk.AffineTransform[itk.D,3].New()
+    tfm.Translate([1.0,2.0,3.0])
+    cache.save("key",tfm)
+    assert cache.load("other") == None
+    assert np.allclose(cache.load("key").GetParameters(),
+        tfm.GetParameters())
+
+def test_registration_reuses_and_invalidates_transforms(rng, tmp_path,
+                                                         monkeypatch):
+    filenames = []
+    for i,shift in enumerate([0,1,2]):
+        filenames.append(os.path.join(str(tmp_path),"CTP{}.mha".format(i)))
+        itk.imwrite(make_head(rng,shift),filenames[-1])
+    saved = []
+    save = CTP_TransformCache.save
+    def record_save(self, key, tfm):
+        saved.append(key)
+        save(self,key,tfm)
+    monkeypatch.setattr(CTP_TransformCache,"save",record_save)
+    def register():
+        del saved[:]
+        scv_register_ctp_images(0,filenames,str(tmp_path),quiet,
+            use_transform_cache=True,write_frames=False)
+        return list(saved)
+
+    # Miss, then hit
+    assert len(register()) == 2
+    assert register() == []
+    # A changed frame is registered again
+    itk.imwrite(make_head(rng,3),filenames[2])
+    assert len(register()) == 1
+    assert len(os.listdir(os.path.join(str(tmp_path),"transform_cache"))) \
+        == 3
+
+def test_cache_is_off_by_default(rng, tmp_path):
+    filenames = []
+    for i in range(2):
+        filenames.append(os.path.join(str(tmp_path),"CTP{}.mha".format(i)))
+        itk.imwrite(make_head(rng),filenames[-1])
+    scv_register_ctp_images(0,filenames,str(tmp_path),quiet,
+        write_frames=False)
+    assert not os.path.exists(os.path.join(str(tmp_path),"transform_cache"))
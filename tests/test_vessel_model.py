@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+import itk
+
+import StroCoVess_Lib
+from conftest import make_image, quiet
+from StroCoVess_Lib import scv_enhance_vessels_in_cta
+from StroCoVess_Lib import scv_load_vessel_model, scv_save_vessel_model
+
+
+def make_cta(rng, size=80, num_vessels=12):
+    # Bone shell around a brain with bright straight vessels of 1 to 2
+    #   voxels radius, with 8 HU noise.  Returns the CTA, the brain CTA
+    #   (0 outside of the brain), and the vessel voxels.
+    shape = [size//2+16,size,size]
+    z,y,x = np.meshgrid(*[np.arange(n,dtype=np.float64)-n/2 for n in shape],
+        indexing='ij')
+    r = np.sqrt((x/(0.45*size))**2+(y/(0.4*size))**2+(z/(0.4*size))**2)
+    arr = np.full(shape,-1000.0)
+    brain = r < 0.9
+    arr[brain] = 40
+    arr[(r >= 0.9) & (r < 1.0)] = 1000
+    points = np.stack([z,y,x],-1)
+    vessels = np.zeros(shape,dtype=bool)
+    for i in range(num_vessels):
+        center = rng.uniform(-0.25,0.25,3)*np.array(shape)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        offset = points-center
+        dist = np.linalg.norm(offset-(offset@direction)[...,None]*direction,
+            axis=-1)
+        radius = rng.uniform(1.0,2.0)
+        vessels |= brain & (dist < radius)
+        arr += brain*250*np.exp(-dist**2/(2*radius**2))
+    arr += rng.normal(0,8,shape)
+    return make_image(arr),make_image(np.where(brain,arr,0)),vessels
+
+
+def test_pretrained_model_classifies_without_initial_vessels(rng, tmp_path,
+                                                             monkeypatch):
+    model_filename = os.path.join(str(tmp_path),"model.npz")
+    cta_im,brain_im,vessels = make_cta(rng)
+    scv_enhance_vessels_in_cta(cta_im,brain_im,quiet,output_dirname=None,
+        vessel_model_filename=model_filename)
+    model = scv_load_vessel_model(model_filename)
+    assert len(model["scales"]) == 3
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Initial vessels extracted")
+    monkeypatch.setattr(StroCoVess_Lib,"scv_extract_seed_tubes",fail)
+    cta_im,brain_im,vessels = make_cta(rng)
+    vess_im,brain_vess_im = scv_enhance_vessels_in_cta(cta_im,brain_im,
+        quiet,output_dirname=None,vessel_model_filename=model_filename,
+        vessel_model_mode="pretrained")
+    vess_arr = itk.GetArrayFromImage(vess_im)
+    brain = itk.GetArrayFromImage(brain_im) != 0
+    assert np.mean(vess_arr[vessels] > 0) > 0.75
+    assert np.mean(vess_arr[brain & ~vessels] > 0) < 0.15
+
+def test_model_version_is_checked(tmp_path):
+    model_filename = os.path.join(str(tmp_path),"model.npz")
+    scv_save_vessel_model({"version": -1},model_filename)
+    with pytest.raises(ValueError):
+        scv_load_vessel_model(model_filename)
+    with pytest.raises(ValueError):
+        scv_enhance_vessels_in_cta(None,None,quiet,
+            vessel_model_mode="update")